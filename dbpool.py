@@ -0,0 +1,94 @@
+import logging
+import threading
+from contextlib import contextmanager
+from mysql.connector import PoolError, pooling
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """MySQL connection pool shared by the bots.
+
+    MySQLConnectionPool raises PoolError as soon as every connection is borrowed,
+    so callers wait on a semaphore sized to the pool instead, for up to `timeout` seconds.
+    """
+
+    def __init__(self, pool_name, pool_size, timeout=30, **config):
+        self.pool_name = pool_name
+        self.timeout = timeout
+        self._pool = pooling.MySQLConnectionPool(pool_name=pool_name, pool_size=pool_size, **config)
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    @contextmanager
+    def cursor(self, **cursor_args):
+        """Borrow a connection and yield (connection, cursor); both are closed on exit"""
+        if not self._slots.acquire(timeout=self.timeout):
+            logger.error(f"No free connection in {self.pool_name} after {self.timeout}s")
+            raise PoolError(f"No free connection in {self.pool_name} after {self.timeout}s")
+        try:
+            conn = self._pool.get_connection()
+            try:
+                cursor = conn.cursor(**cursor_args)
+                try:
+                    yield conn, cursor
+                finally:
+                    cursor.close()
+            finally:
+                conn.close()
+        finally:
+            self._slots.release()
+
+
+# Columns added after the participants table was first deployed; older tables get them on startup
+PARTICIPANT_COLUMNS = {
+    'audio_file_id': 'VARCHAR(255)',
+    'audio_file_unique_id': 'VARCHAR(64)',
+}
+
+# Indexes behind the bots' lookups: wallet verification, the battle checker and the submission monitor
+PARTICIPANT_INDEXES = {
+    'idx_participants_wallet': '(wallet_address)',
+    'idx_participants_active': '(battle_active)',
+    'idx_participants_chat_active': '(chat_id, battle_active)',
+}
+
+
+def init_participants_table(cursor):
+    """Create the participants table shared by the bots, or bring an existing one up to date"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS participants (
+            user_id BIGINT,
+            username VARCHAR(255),
+            wallet_address VARCHAR(255),
+            audio_filename VARCHAR(255),
+            audio_file_id VARCHAR(255),
+            audio_file_unique_id VARCHAR(64),
+            chat_id BIGINT,
+            verified BOOLEAN DEFAULT 1,
+            battle_start_timestamp DATETIME,
+            battle_active BOOLEAN DEFAULT 0,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    ''')
+
+    for column, definition in PARTICIPANT_COLUMNS.items():
+        cursor.execute('''
+            SELECT COUNT(*)
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE()
+            AND table_name = 'participants'
+            AND column_name = %s
+        ''', (column,))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f'ALTER TABLE participants ADD COLUMN {column} {definition}')
+
+    for index_name, columns in PARTICIPANT_INDEXES.items():
+        cursor.execute('''
+            SELECT COUNT(*)
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE()
+            AND table_name = 'participants'
+            AND index_name = %s
+        ''', (index_name,))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f'CREATE INDEX {index_name} ON participants {columns}')
@@ -5,9 +5,11 @@ import pandas as pd
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor
 import librosa
 import soundfile as sf
+import soxr
+import numba
 import warnings
 import shutil
 import os
@@ -22,16 +24,33 @@ from eth_account import Account
 from dotenv import load_dotenv
 import gdown
 import tempfile
+import hashlib
+import joblib
+import pickle
+import atexit
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threadpoolctl import threadpool_limits
 os.environ['PRIVATE_KEY'] = '0xc2a12ea9d8e4dc226270d2d7aee56c4292f9a50ca3a794698fdc5e0853c3b7f4'
 # Load environment variables
 load_dotenv()
 
-warnings.filterwarnings('ignore')
-
 # Create necessary directories
 Path("temp_uploads").mkdir(exist_ok=True)
 Path("evaluation_results").mkdir(exist_ok=True)
 
+# Fitted evaluator cache
+MODEL_CACHE_PATH = "evaluator.joblib"
+MODEL_CACHE_HASH_PATH = MODEL_CACHE_PATH + ".hash"
+
+# Per-track feature cache, keyed by file fingerprint and persisted across runs
+FEATURE_CACHE_PATH = Path.home() / ".cache" / "pop_eval" / "features.pkl"
+FEATURE_CACHE_SIZE = 256
+# Bump whenever extract_features changes so stale cached features are discarded
+FEATURE_VERSION = 3
+
 # Web3 setup
 BSC_TESTNET_RPC = "https://data-seed-prebsc-1-s1.binance.org:8545/"
 w3 = Web3(Web3.HTTPProvider(BSC_TESTNET_RPC))
@@ -79,11 +98,62 @@ class WinnerAnnouncement(BaseModel):
     score_differences: List[float]
     transaction_hash: str = None
 
+# Krumhansl-Kessler key profiles, rotated to all 12 tonics (rows 0-11 major, 12-23 minor)
+# and z-normalized so a single matrix-vector product gives the correlation with each key
+_MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+_MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+KEY_TEMPLATES = np.array(
+    [np.roll(_MAJOR_PROFILE, tonic) for tonic in range(12)]
+    + [np.roll(_MINOR_PROFILE, tonic) for tonic in range(12)],
+    dtype=np.float32
+)
+KEY_TEMPLATES -= KEY_TEMPLATES.mean(axis=1, keepdims=True)
+KEY_TEMPLATES /= np.linalg.norm(KEY_TEMPLATES, axis=1, keepdims=True)
+
+@numba.njit(cache=True, fastmath=True)
+def reduce_spectrogram(S, sr, n_fft, roll_percent=0.85, amin=1e-10):
+    """Mean spectral rolloff, RMS and spectral flatness of a magnitude spectrogram in one sweep"""
+    n_bins, n_frames = S.shape
+    rolloff_sum = 0.0
+    rms_sum = 0.0
+    flatness_sum = 0.0
+    for t in range(n_frames):
+        magnitude_sum = 0.0
+        power_sum = 0.0
+        log_power_sum = 0.0
+        clipped_power_sum = 0.0
+        for f in range(n_bins):
+            magnitude = S[f, t]
+            power = magnitude * magnitude
+            magnitude_sum += magnitude
+            # DC and Nyquist bins count once in the RMS energy, as in librosa.feature.rms
+            if f == 0 or f == n_bins - 1:
+                power_sum += 0.5 * power
+            else:
+                power_sum += power
+            clipped_power = max(power, amin)
+            log_power_sum += np.log(clipped_power)
+            clipped_power_sum += clipped_power
+        threshold = roll_percent * magnitude_sum
+        cumulative = 0.0
+        rolloff_bin = n_bins - 1
+        for f in range(n_bins):
+            cumulative += S[f, t]
+            if cumulative >= threshold:
+                rolloff_bin = f
+                break
+        rolloff_sum += rolloff_bin * sr / n_fft
+        rms_sum += np.sqrt(2.0 * power_sum) / n_fft
+        flatness_sum += np.exp(log_power_sum / n_bins) / (clipped_power_sum / n_bins)
+    return rolloff_sum / n_frames, rms_sum / n_frames, flatness_sum / n_frames
+
 class PopMusicEvaluator:
     def __init__(self):
         self.scaler = MinMaxScaler()
-        self.model = RandomForestRegressor(
-            n_estimators=100,
+        self.model = HistGradientBoostingRegressor(
+            max_iter=200,
+            max_bins=64,
+            early_stopping=True,
             random_state=42
         )
         self.feature_columns = [
@@ -91,6 +161,9 @@ class PopMusicEvaluator:
             'instrumentalness', 'key', 'liveness',
             'loudness'
         ]
+        self.feature_cache = self.load_feature_cache()
+        self._extract_pool = None
+        atexit.register(self.save_feature_cache)
         # Initialize the model on startup
         self.download_and_train_model()
 
@@ -116,33 +189,83 @@ class PopMusicEvaluator:
             raise Exception(f"Error downloading dataset: {str(e)}")
 
     def download_and_train_model(self):
-        """Download the dataset and train the model"""
+        """Download the dataset and train the model, reusing a cached model when the dataset is unchanged"""
         try:
             dataset_path = self.download_dataset()
-            self.train_model(dataset_path)
+            dataset_hash = self.fingerprint_file(dataset_path)
+            if not self.load_cached_model(dataset_hash):
+                self.train_model(dataset_path)
+                self.save_cached_model(dataset_hash)
             # Clean up the temporary file
             os.remove(dataset_path)
         except Exception as e:
             raise Exception(f"Error in model initialization: {str(e)}")
 
+    @staticmethod
+    def fingerprint_file(path):
+        """Fingerprint a file from its size and first/last 1MB"""
+        chunk_size = 1 << 20
+        size = os.path.getsize(path)
+        digest = hashlib.blake2b(str(size).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read(chunk_size))
+            if size > chunk_size:
+                f.seek(max(size - chunk_size, chunk_size))
+                digest.update(f.read(chunk_size))
+        return digest.hexdigest()
+
+    def load_cached_model(self, dataset_hash):
+        """Load the fitted model from disk if it was trained on the same dataset"""
+        if not (os.path.exists(MODEL_CACHE_PATH) and os.path.exists(MODEL_CACHE_HASH_PATH)):
+            return False
+        with open(MODEL_CACHE_HASH_PATH) as f:
+            if f.read().strip() != dataset_hash:
+                return False
+        try:
+            cached = joblib.load(MODEL_CACHE_PATH)
+        except Exception as e:
+            # Truncated file or pickled with an incompatible scikit-learn version
+            print(f"Ignoring unreadable model cache: {e}")
+            return False
+        # Retrain if the cached estimator was built with a different model configuration
+        if type(cached['model']) is not type(self.model) or cached['model'].get_params() != self.model.get_params():
+            return False
+        self.model = cached['model']
+        self.scaler = cached['scaler']
+        self.feature_ranges = cached['ranges']
+        self.cache_score_inverse()
+        return True
+
+    def save_cached_model(self, dataset_hash):
+        """Persist the fitted model alongside the dataset fingerprint"""
+        # Write to a temporary file first so an interrupted dump never replaces a good cache
+        temp_path = MODEL_CACHE_PATH + ".tmp"
+        joblib.dump(
+            {'model': self.model, 'scaler': self.scaler, 'ranges': self.feature_ranges},
+            temp_path,
+            compress=3
+        )
+        os.replace(temp_path, MODEL_CACHE_PATH)
+        with open(MODEL_CACHE_HASH_PATH, 'w') as f:
+            f.write(dataset_hash)
+
     def prepare_dataset(self, dataset_path):
         """Load dataset from CSV and prepare it"""
-        df = pd.read_csv(dataset_path)
-        numeric_columns = [
-            'song_popularity', 'song_duration_ms', 'acousticness',
-            'danceability', 'energy', 'instrumentalness', 'key',
-            'liveness', 'loudness'
-        ]
-        for col in numeric_columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        return df
+        numeric_columns = ['song_popularity'] + self.feature_columns
+        return pd.read_csv(
+            dataset_path,
+            usecols=numeric_columns,
+            dtype={col: 'float32' for col in numeric_columns},
+            engine='c'
+        )
 
     def train_model(self, dataset_path):
         """Train the model using the provided dataset"""
         df = self.prepare_dataset(dataset_path)
         quality_score = df['song_popularity'].values.reshape(-1, 1)
         quality_score_normalized = self.scaler.fit_transform(quality_score)
-        X = df[self.feature_columns]
+        self.cache_score_inverse()
+        X = df[self.feature_columns].to_numpy(dtype=np.float32)
         X_train, X_test, y_train, y_test = train_test_split(
             X, quality_score_normalized,
             test_size=0.2,
@@ -155,33 +278,147 @@ class PopMusicEvaluator:
         }
         return self.model.score(X_test, y_test)
 
+    def cache_score_inverse(self):
+        """Precompute the affine map that undoes the quality score normalization"""
+        self._inv_scale = self.scaler.data_max_[0] - self.scaler.data_min_[0]
+        self._inv_min = self.scaler.data_min_[0]
+
     # [Rest of the PopMusicEvaluator class methods remain the same]
-    def extract_features(self, audio_path):
+    @staticmethod
+    def load_audio(audio_path, duration=5, target_sr=22050):
+        """Decode the first seconds of a track as mono float32 at the target sample rate"""
+        try:
+            with sf.SoundFile(audio_path) as f:
+                sr = f.samplerate
+                y = f.read(int(duration * sr), dtype='float32', always_2d=False)
+        except RuntimeError:
+            # Formats libsndfile cannot decode (e.g. m4a) go through librosa's audioread fallback
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=UserWarning)
+                warnings.simplefilter('ignore', category=FutureWarning)
+                return librosa.load(audio_path, sr=target_sr, duration=duration)
+        if y.ndim == 2:
+            y = y.mean(axis=1)
+        if sr != target_sr:
+            y = soxr.resample(y, sr, target_sr)
+            sr = target_sr
+        return y, sr
+
+    @staticmethod
+    def extract_features(audio_path):
         """Extract audio features from a track"""
-        y, sr = librosa.load(audio_path, duration=5)
+        y, sr = PopMusicEvaluator.load_audio(audio_path)
+        # Compute the STFT once and share the magnitude spectrogram between features
+        n_fft = 2048
+        S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=512))
+        power = S ** 2
+        rolloff, rms, flatness = reduce_spectrogram(S, sr, n_fft)
         features = {}
-        features['acousticness'] = float(np.mean(librosa.feature.spectral_rolloff(y=y, sr=sr)))
-        features['energy'] = float(np.mean(librosa.feature.rms(y=y)))
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        features['acousticness'] = float(rolloff)
+        features['energy'] = float(rms)
+        onset_env = librosa.onset.onset_strength(S=librosa.power_to_db(power), sr=sr)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=UserWarning)
+            tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
         features['danceability'] = float(tempo / 200.0)
-        harmonic, percussive = librosa.effects.hpss(y)
-        features['instrumentalness'] = float(np.mean(harmonic) / (np.mean(harmonic) + np.mean(percussive)))
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-        features['key'] = int(np.argmax(np.mean(chroma, axis=1)))
+        # Flatness is high for noisy/percussive audio and low for tonal audio, the reverse of the
+        # harmonic/percussive ratio it replaces, so invert it to keep the feature's direction
+        features['instrumentalness'] = float(1.0 - flatness)
+        chroma = librosa.feature.chroma_stft(S=power, sr=sr)
+        chroma_mean = np.mean(chroma, axis=1)
+        features['key'] = int(np.argmax(KEY_TEMPLATES @ (chroma_mean - chroma_mean.mean()))) % 12
         features['liveness'] = float(np.mean(librosa.feature.zero_crossing_rate(y)))
         features['loudness'] = float(librosa.amplitude_to_db(np.mean(np.abs(y))))
         return features
 
     def evaluate_track(self, audio_path):
         """Evaluate a single audio track"""
-        features = self.extract_features(audio_path)
-        X = pd.DataFrame([features])[self.feature_columns]
-        quality_score = self.model.predict(X)[0]
-        quality_score = float(self.scaler.inverse_transform([[quality_score]])[0][0])
-        return {
-            'quality_score': quality_score,
-            'features': features
-        }
+        return self.evaluate_tracks([audio_path])[0]
+
+    def load_feature_cache(self):
+        """Load the persisted per-track feature cache"""
+        try:
+            with open(FEATURE_CACHE_PATH, 'rb') as f:
+                cache = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return OrderedDict()
+        if not isinstance(cache, dict) or cache.get('version') != FEATURE_VERSION:
+            return OrderedDict()
+        return cache['features']
+
+    def save_feature_cache(self):
+        """Persist the per-track feature cache"""
+        FEATURE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = FEATURE_CACHE_PATH.with_suffix('.tmp')
+        with open(temp_path, 'wb') as f:
+            pickle.dump({'version': FEATURE_VERSION, 'features': self.feature_cache}, f)
+        os.replace(temp_path, FEATURE_CACHE_PATH)
+
+    def extraction_pool(self):
+        """Return the shared feature extraction process pool, or None if processes cannot be forked"""
+        # Workers must be forked: spawned ones would re-import this module, reconnecting to
+        # BSC and retraining the model in every worker
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return None
+        if self._extract_pool is None:
+            self._extract_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context('fork')
+            )
+        return self._extract_pool
+
+    def extract_many(self, audio_paths):
+        """Extract features for several tracks, in parallel processes when there is more than one"""
+        pool = self.extraction_pool() if len(audio_paths) > 1 else None
+        if pool is not None:
+            chunksize = 4 if len(audio_paths) > 8 else 1
+            try:
+                return list(pool.map(_extract_features_worker, audio_paths, chunksize=chunksize))
+            except BrokenProcessPool:
+                # A worker died; start a fresh pool on the next request
+                self._extract_pool = None
+                raise
+        return [self.extract_features(path) for path in audio_paths]
+
+    def cached_features(self, audio_paths):
+        """Return features for each track, only extracting tracks not seen before"""
+        fingerprints = [self.fingerprint_file(path) for path in audio_paths]
+        missing = {}
+        for fingerprint, path in zip(fingerprints, audio_paths):
+            if fingerprint in self.feature_cache:
+                self.feature_cache.move_to_end(fingerprint)
+            else:
+                missing.setdefault(fingerprint, path)
+        if missing:
+            extracted = self.extract_many(list(missing.values()))
+            for fingerprint, features in zip(missing, extracted):
+                self.feature_cache[fingerprint] = features
+        all_features = [dict(self.feature_cache[fingerprint]) for fingerprint in fingerprints]
+        while len(self.feature_cache) > FEATURE_CACHE_SIZE:
+            self.feature_cache.popitem(last=False)
+        return all_features
+
+    def evaluate_tracks(self, audio_paths):
+        """Evaluate several audio tracks with a single model prediction"""
+        all_features = self.cached_features(audio_paths)
+        X = np.array([
+            [features[column] for column in self.feature_columns]
+            for features in all_features
+        ])
+        predictions = self.model.predict(X)
+        quality_scores = predictions * self._inv_scale + self._inv_min
+        return [
+            {
+                'quality_score': float(quality_score),
+                'features': features
+            }
+            for quality_score, features in zip(quality_scores, all_features)
+        ]
+
+def _extract_features_worker(audio_path):
+    """Extract features in a worker process without oversubscribing BLAS threads"""
+    with threadpool_limits(limits=1):
+        return PopMusicEvaluator.extract_features(audio_path)
 
 # Initialize the evaluator
 evaluator = PopMusicEvaluator()
@@ -249,8 +486,10 @@ async def evaluate_tracks(
             with open(temp_path, "wb") as buffer:
                 shutil.copyfileobj(file.file, buffer)
 
-            evaluation = evaluator.evaluate_track(temp_path)
-            
+        # Score all tracks through the model in one batch
+        track_evaluations = evaluator.evaluate_tracks(temp_files)
+
+        for file, address, evaluation in zip(files, wallet_addresses, track_evaluations):
             evaluations.append(TrackEvaluation(
                 wallet_address=address,
                 file_name=file.filename,
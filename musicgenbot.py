@@ -1,15 +1,45 @@
-import os
+import sys
 import asyncio
 import logging
-import mysql.connector
 from mysql.connector import Error
+from mysql.connector.constants import ClientFlag
 import threading
 import aiohttp
-import nest_asyncio
-import base64
+from aiohttp import web
+from aiolimiter import AsyncLimiter
+import binascii
+import hashlib
+import io
+import re
+import secrets
+import json
+import uuid
+from enum import IntEnum
+from cachetools import TTLCache
 from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
 from telebot import types
 from telebot.types import ReplyKeyboardMarkup, ReplyKeyboardRemove
+from dbpool import ConnectionPool, init_participants_table
+
+# uvloop is an optional, faster event loop; it is not available on Windows
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# orjson is an optional, faster JSON encoder for the model API requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pybase64 is an optional, SIMD-accelerated base64 decoder for the generated audio
+try:
+    import pybase64
+    b64decode = pybase64.b64decode
+except ImportError:
+    b64decode = binascii.a2b_base64
 
 # Logging setup
 logging.basicConfig(
@@ -18,7 +48,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-nest_asyncio.apply()
+# Notebooks (Jupyter/Colab) already run an event loop; only patch it for re-entrancy there
+if 'ipykernel' in sys.modules or 'google.colab' in sys.modules:
+    import nest_asyncio
+    nest_asyncio.apply()
 
 class ParticipantsDatabase:
     def __init__(self):
@@ -28,153 +61,289 @@ class ParticipantsDatabase:
             'user': 'sql12754910',
             'password': 'nDWLkDNtTI'
         }
-        self._lock = threading.Lock()
+        self.pool = ConnectionPool(
+            pool_name='participants_pool',
+            pool_size=8,
+            # Report matched rather than changed rows, so UPDATE rowcount tells us whether the row exists
+            client_flags=[ClientFlag.FOUND_ROWS],
+            **self.db_config
+        )
+        # Wallet -> user_id for wallets already found in the database. Only hits are cached,
+        # since the staking bot can register a wallet at any time.
+        self._wallet_owners = TTLCache(maxsize=4096, ttl=300)
+        self._wallet_owners_lock = threading.Lock()
         self._create_tables()
 
-    def _get_connection(self):
-        """Create and return a new database connection"""
-        try:
-            connection = mysql.connector.connect(**self.db_config)
-            return connection
-        except Error as e:
-            logger.error(f"Error connecting to MySQL Database: {e}")
-            raise
-
     def _create_tables(self):
         """Create database tables if they don't exist"""
-        connection = self._get_connection()
-        cursor = connection.cursor()
-
         try:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS participants (
-                    user_id BIGINT,
-                    username VARCHAR(255),
-                    wallet_address VARCHAR(42),
-                    audio_filename VARCHAR(255),
-                    audio_data LONGBLOB,
-                    chat_id BIGINT,
-                    verified BOOLEAN DEFAULT TRUE,
-                    battle_start_timestamp DATETIME,
-                    battle_active BOOLEAN DEFAULT FALSE,
-                    PRIMARY KEY (user_id, chat_id)
-                )
-            ''')
-            connection.commit()
+            with self.pool.cursor() as (connection, cursor):
+                init_participants_table(cursor)
+                connection.commit()
         except Error as e:
             logger.error(f"Error creating tables: {e}")
             raise
-        finally:
-            cursor.close()
-            connection.close()
+
+    def _lookup_user_id(self, wallet_address):
+        """Return the user_id registered for a wallet address, or None if there is none"""
+        with self._wallet_owners_lock:
+            user_id = self._wallet_owners.get(wallet_address)
+        if user_id is not None:
+            return user_id
+
+        with self.pool.cursor() as (connection, cursor):
+            cursor.execute('''
+            SELECT user_id
+            FROM participants
+            WHERE wallet_address = %s
+            LIMIT 1
+            ''', (wallet_address,))
+            result = cursor.fetchone()
+
+        if result is None:
+            return None
+        with self._wallet_owners_lock:
+            self._wallet_owners[wallet_address] = result[0]
+        return result[0]
 
     def verify_participant(self, wallet_address, user_id):
         """Verify if a participant exists with the given wallet address and matches the user"""
-        with self._lock:
-            connection = self._get_connection()
-            cursor = connection.cursor()
-            try:
-                cursor.execute('''
-                SELECT user_id
-                FROM participants
-                WHERE wallet_address = %s
-                ''', (wallet_address,))
-                result = cursor.fetchone()
+        try:
+            db_user_id = self._lookup_user_id(wallet_address)
+        except Error as e:
+            logger.error(f"Database error: {e}")
+            return False, f"Database error: {str(e)}"
 
-                if result is None:
-                    return False, "No participant found with this wallet address"
-
-                db_user_id = result[0]
-                if db_user_id != user_id:
-                    return False, "Wallet address belongs to a different user"
-
-                return True, "Participant verified successfully"
-            except Error as e:
-                logger.error(f"Database error: {e}")
-                return False, f"Database error: {str(e)}"
-            finally:
-                cursor.close()
-                connection.close()
-
-    def update_participant_audio(self, user_id, audio_file_path):
-        """Update participant's audio with binary data from the file"""
-        with self._lock:
-            connection = self._get_connection()
-            cursor = connection.cursor()
-            try:
-                # Check if participant exists
-                cursor.execute('''
-                SELECT COUNT(*)
-                FROM participants
-                WHERE user_id = %s
-                ''', (user_id,))
+        if db_user_id is None:
+            return False, "No participant found with this wallet address"
 
-                if cursor.fetchone()[0] == 0:
-                    return False, "Participant not found"
+        if db_user_id != user_id:
+            return False, "Wallet address belongs to a different user"
 
-                # Read binary data from the audio file
-                with open(audio_file_path, 'rb') as audio_file:
-                    audio_data = audio_file.read()
+        return True, "Participant verified successfully"
 
-                # Update both audio data and filename
+    def update_participant_audio(self, user_id, audio_file_id, audio_file_unique_id, audio_filename):
+        """Record the Telegram file_id and filename of a participant's audio"""
+        try:
+            with self.pool.cursor() as (connection, cursor):
+                # Update the file ids and filename; no matched rows means no such participant
                 cursor.execute('''
                 UPDATE participants
-                SET audio_data = %s, audio_filename = %s
+                SET audio_file_id = %s, audio_file_unique_id = %s, audio_filename = %s
                 WHERE user_id = %s
-                ''', (audio_data, os.path.basename(audio_file_path), user_id))
+                ''', (audio_file_id, audio_file_unique_id, audio_filename, user_id))
 
                 connection.commit()
+                if cursor.rowcount == 0:
+                    return False, "Participant not found"
                 return True, "Audio file updated successfully"
-            except Error as e:
-                logger.error(f"Database error: {e}")
-                return False, f"Database error: {str(e)}"
-            except IOError as e:
-                logger.error(f"File error: {e}")
-                return False, f"File error: {str(e)}"
-            finally:
-                cursor.close()
-                connection.close()
+        except Error as e:
+            logger.error(f"Database error: {e}")
+            return False, f"Database error: {str(e)}"
 
     def get_participant_audio(self, user_id):
-        """Retrieve audio data and filename for a participant"""
-        with self._lock:
-            connection = self._get_connection()
-            cursor = connection.cursor()
-            try:
+        """Retrieve the audio file_id and filename for a participant"""
+        try:
+            with self.pool.cursor() as (connection, cursor):
                 cursor.execute('''
-                SELECT audio_data, audio_filename
+                SELECT audio_file_id, audio_filename
                 FROM participants
                 WHERE user_id = %s
                 ''', (user_id,))
                 result = cursor.fetchone()
-                if result:
-                    return result[0], result[1]  # Returns (audio_data, filename)
-                return None, None
-            except Error as e:
-                logger.error(f"Database error: {e}")
-                return None, None
-            finally:
-                cursor.close()
-                connection.close()
+            if result:
+                return result[0], result[1]  # Returns (file_id, filename)
+            return None, None
+        except Error as e:
+            logger.error(f"Database error: {e}")
+            return None, None
 
 # Bot initialization and configuration
 BOT_TOKEN = '****************************'
 MUSIC_MODEL_API = '**********************************'
-TEMP_DIR = 'temp_audio'  # Directory for temporary audio files
+WEBHOOK_URL = None  # Public HTTPS base URL for Telegram to push updates to; None uses long polling
+WEBHOOK_PORT = 8080
+
+# Telegram allows ~30 messages/s per bot; stay a little under to avoid 429 back-offs
+SEND = AsyncLimiter(28, 1)
 
-# Create temporary directory if it doesn't exist
-os.makedirs(TEMP_DIR, exist_ok=True)
+def get_retry_after(e):
+    """Seconds Telegram asked us to wait in a 429 error, or None for other errors"""
+    if e.error_code != 429:
+        return None
+    return (e.result_json or {}).get('parameters', {}).get('retry_after', 5)
 
-bot = AsyncTeleBot(BOT_TOKEN)
+class RateLimitedTeleBot(AsyncTeleBot):
+    """AsyncTeleBot whose outbound calls share a single send rate limit"""
+
+    async def _send(self, method, *args, **kwargs):
+        """Call a send method under the rate limit, waiting out a flood-control 429 once"""
+        try:
+            async with SEND:
+                return await method(*args, **kwargs)
+        except ApiTelegramException as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None:
+                raise
+            logger.warning(f"Telegram flood control, retrying in {retry_after}s")
+        await asyncio.sleep(retry_after)
+        # The first attempt read any uploaded file to the end; rewind it so the retry sends it whole
+        for arg in (*args, *kwargs.values()):
+            if hasattr(arg, 'seek'):
+                arg.seek(0)
+        async with SEND:
+            return await method(*args, **kwargs)
+
+    async def send_message(self, *args, **kwargs):
+        # reply_to() goes through send_message(), so replies are limited too
+        return await self._send(super().send_message, *args, **kwargs)
+
+    async def send_audio(self, *args, **kwargs):
+        return await self._send(super().send_audio, *args, **kwargs)
+
+    async def delete_message(self, *args, **kwargs):
+        return await self._send(super().delete_message, *args, **kwargs)
+
+bot = RateLimitedTeleBot(BOT_TOKEN)
 db_manager = ParticipantsDatabase()
 
+# Shared HTTP session for the music generation API, created in main()
+SESSION: aiohttp.ClientSession = None
+
+# Locates the start of the base64 "audio" string in the model API's JSON response
+AUDIO_FIELD_PATTERN = re.compile(rb'"audio"\s*:\s*"')
+# A JSON string escape, and what each single-character escape stands for
+JSON_ESCAPE_PATTERN = re.compile(rb'\\(u[0-9a-fA-F]{4}|.)', re.DOTALL)
+JSON_ESCAPES = {b'"': b'"', b'\\': b'\\', b'/': b'/', b'b': b'\b', b'f': b'\f', b'n': b'\n', b'r': b'\r', b't': b'\t'}
+# An escape cut off at the end of a chunk: an unpaired trailing backslash, or "\u" missing hex digits
+PARTIAL_ESCAPE_PATTERN = re.compile(rb'(?<!\\)(?:\\\\)*(\\(?:u[0-9a-fA-F]{0,3})?)$')
+
+def unescape_json(match):
+    """re.sub callback that decodes one JSON_ESCAPE_PATTERN match"""
+    escape = match.group(1)
+    if len(escape) == 5:
+        return chr(int(escape[1:], 16)).encode()
+    return JSON_ESCAPES.get(escape, escape)
+
+async def read_base64_audio(response):
+    """Decode the JSON response's base64 audio field chunk by chunk as the body streams in"""
+    audio = io.BytesIO()
+    head = b''
+    pending = b''
+    pending_escape = b''
+    in_audio = False
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        if not in_audio:
+            head += chunk
+            match = AUDIO_FIELD_PATTERN.search(head)
+            if match is None:
+                # Keep a tail in case the field name is split across chunks
+                head = head[-64:]
+                continue
+            in_audio = True
+            chunk = head[match.end():]
+            head = b''
+        # Base64 contains no quotes, so the first one closes the string
+        end = chunk.find(b'"')
+        raw = pending_escape + (chunk if end == -1 else chunk[:end])
+        pending_escape = b''
+        partial = PARTIAL_ESCAPE_PATTERN.search(raw)
+        if partial and end == -1:
+            # Finish this escape once the next chunk arrives
+            pending_escape = raw[partial.start(1):]
+            raw = raw[:partial.start(1)]
+        # Undo JSON escaping (e.g. "\/"), then drop the whitespace of any line wrapping
+        data = pending + JSON_ESCAPE_PATTERN.sub(unescape_json, raw).translate(None, b' \t\r\n')
+        aligned = len(data) - len(data) % 4
+        audio.write(b64decode(data[:aligned]))
+        pending = data[aligned:]
+        if end != -1:
+            if pending:
+                audio.write(b64decode(pending))
+            return audio.getvalue() or None
+    return None
+
+class State(IntEnum):
+    """Conversation state of a user"""
+    IDLE = 0
+    AWAIT_WALLET = 1
+    AWAIT_PROMPT = 2
+    AWAIT_SATISFACTION = 3
+
+# Pending model API calls keyed by normalized prompt, shared by concurrent identical requests
+INFLIGHT_GENERATIONS = {}
+
+# Caps concurrent calls to the GPU-bound model server; further prompts queue here
+MODEL_API_SEMAPHORE = asyncio.Semaphore(4)
+
+async def request_music(prompt):
+    """Call the music generation API and return (status, audio bytes)"""
+    key = prompt.strip().lower()
+    pending = INFLIGHT_GENERATIONS.get(key)
+    if pending is not None:
+        # Shield so one follower giving up does not cancel the shared call
+        return await asyncio.shield(pending)
+
+    future = asyncio.get_running_loop().create_future()
+    INFLIGHT_GENERATIONS[key] = future
+    try:
+        async with MODEL_API_SEMAPHORE, SESSION.post(MUSIC_MODEL_API, json={'data': [prompt]}) as response:
+            # Decode the base64 audio while the response streams in
+            audio_binary = await read_base64_audio(response) if response.status == 200 else None
+            result = (response.status, audio_binary)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved in case no other request was waiting on it
+        future.exception()
+        raise
+    finally:
+        del INFLIGHT_GENERATIONS[key]
+
+# Telegram uploads of generated tracks keyed by content digest, as futures of their file_id.
+# Users whose identical prompts shared one generation get the track by file_id instead of a new upload.
+AUDIO_UPLOADS = TTLCache(maxsize=1024, ttl=3600)
+
+async def send_generated_audio(chat_id, audio_binary, audio_filename):
+    """Send a generated track and return the sent Audio, uploading each distinct track only once"""
+    key = hashlib.blake2b(audio_binary, digest_size=16).digest()
+    upload = AUDIO_UPLOADS.get(key)
+    if upload is not None:
+        # None means the first upload failed; fall back to uploading the bytes here
+        file_id = await asyncio.shield(upload)
+        if file_id is not None:
+            sent = await bot.send_audio(chat_id, file_id)
+            return sent.audio or sent.document
+
+    future = asyncio.get_running_loop().create_future()
+    AUDIO_UPLOADS[key] = future
+    try:
+        audio = io.BytesIO(audio_binary)
+        audio.name = audio_filename
+        sent = await bot.send_audio(chat_id, audio)
+    except BaseException:
+        AUDIO_UPLOADS.pop(key, None)
+        future.set_result(None)
+        raise
+    sent_file = sent.audio or sent.document
+    future.set_result(sent_file.file_id)
+    return sent_file
+
 # Rest of the code remains the same from here...
-user_states = {}
-user_last_audio = {}
+user_states = TTLCache(maxsize=10_000, ttl=3600)
+# Generated tracks awaiting a Submit/No answer, as (filename, Telegram file_id, file_unique_id)
+user_last_audio = TTLCache(maxsize=10_000, ttl=3600)
+
+# 0x-prefixed 20-byte hex address
+WALLET_ADDRESS_PATTERN = re.compile(r'0x[0-9a-fA-F]{40}')
 
 def validate_wallet_address(address):
     """Basic wallet address format validation"""
-    return address.startswith('0x') and len(address) == 42
+    return WALLET_ADDRESS_PATTERN.fullmatch(address) is not None
 
 @bot.message_handler(commands=['start'])
 async def send_welcome(message):
@@ -183,9 +352,8 @@ async def send_welcome(message):
         "Please provide your Ethereum wallet address to verify your participation."
     )
     await bot.reply_to(message, welcome_text)
-    user_states[message.from_user.id] = 'awaiting_wallet_address'
+    user_states[message.from_user.id] = State.AWAIT_WALLET
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id) == 'awaiting_wallet_address')
 async def verify_wallet(message):
     wallet_address = message.text.strip()
 
@@ -193,7 +361,8 @@ async def verify_wallet(message):
         await bot.reply_to(message, "Invalid wallet address format. Please provide a valid Ethereum address.")
         return
 
-    success, msg = db_manager.verify_participant(
+    success, msg = await asyncio.to_thread(
+        db_manager.verify_participant,
         wallet_address=wallet_address,
         user_id=message.from_user.id
     )
@@ -205,95 +374,79 @@ async def verify_wallet(message):
             "Use /about to learn more about the bot"
         )
         await bot.reply_to(message, welcome_text)
-        user_states[message.from_user.id] = None
+        user_states[message.from_user.id] = State.IDLE
     else:
         await bot.reply_to(message, f"Verification failed: {msg}")
 
 @bot.message_handler(commands=['generate'])
 async def initiate_generation(message):
     await bot.reply_to(message, "Please send me a text prompt describing the music you want to generate.")
-    user_states[message.from_user.id] = 'awaiting_prompt'
+    user_states[message.from_user.id] = State.AWAIT_PROMPT
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id) == 'awaiting_prompt')
 async def generate_music(message):
     """Handle music generation requests with base64 audio response"""
     waiting_message = await bot.reply_to(message, "Please wait till we perform magic (create your music audio file)...")
 
     try:
-        # Prepare the request to the music generation API
-        payload = {
-            'data': [message.text]
-        }
+        # Generate the track, sharing the API call with identical in-flight prompts
+        status, audio_binary = await request_music(message.text)
 
-        # Make POST request to the music generation API using aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(MUSIC_MODEL_API, json=payload) as response:
-                if response.status == 200:
-                    response_data = await response.json()
-                    base64_audio = response_data.get('data', {}).get('audio')
+        if status == 200:
+            if not audio_binary:
+                await bot.reply_to(message, "Error: No audio data received from the server.")
+                user_states[message.from_user.id] = State.IDLE
+                return
 
-                    if not base64_audio:
-                        await bot.reply_to(message, "Error: No audio data received from the server.")
-                        user_states[message.from_user.id] = None
-                        return
+            # Create a unique filename for the track
+            audio_filename = f'generated_music_{message.from_user.id}_{uuid.uuid4().hex}.mp3'
 
-                    # Decode base64 string to binary audio data
-                    audio_binary = base64.b64decode(base64_audio)
+            # Send the audio straight from memory, or by file_id if this track was already uploaded
+            sent_file = await send_generated_audio(message.chat.id, audio_binary, audio_filename)
 
-                    # Create a unique filename in the temporary directory
-                    audio_file_path = os.path.join(TEMP_DIR, f'generated_music_{message.from_user.id}_{int(asyncio.get_event_loop().time())}.mp3')
+            # Delete the waiting message
+            await bot.delete_message(message.chat.id, waiting_message.message_id)
 
-                    # Save the decoded audio to an MP3 file
-                    with open(audio_file_path, 'wb') as f:
-                        f.write(audio_binary)
+            # Telegram now hosts the track; keep its file_id for potential submission
+            user_last_audio[message.from_user.id] = (audio_filename, sent_file.file_id, sent_file.file_unique_id)
 
-                    # Send the audio file
-                    with open(audio_file_path, 'rb') as audio:
-                        await bot.send_audio(message.chat.id, audio)
+            # Ask for satisfaction with submit option
+            satisfaction_markup = ReplyKeyboardMarkup(row_width=2)
+            submit_button = types.KeyboardButton('Submit')
+            no_button = types.KeyboardButton('No')
+            satisfaction_markup.add(submit_button, no_button)
 
-                    # Delete the waiting message
-                    await bot.delete_message(message.chat.id, waiting_message.message_id)
-
-                    # Store the audio file path for potential submission
-                    user_last_audio[message.from_user.id] = audio_file_path
-
-                    # Ask for satisfaction with submit option
-                    satisfaction_markup = ReplyKeyboardMarkup(row_width=2)
-                    submit_button = types.KeyboardButton('Submit')
-                    no_button = types.KeyboardButton('No')
-                    satisfaction_markup.add(submit_button, no_button)
-
-                    await bot.send_message(
-                        message.chat.id,
-                        "Do you want to submit this audio or generate a new one?",
-                        reply_markup=satisfaction_markup
-                    )
+            await bot.send_message(
+                message.chat.id,
+                "Do you want to submit this audio or generate a new one?",
+                reply_markup=satisfaction_markup
+            )
 
-                    user_states[message.from_user.id] = 'awaiting_satisfaction'
-                else:
-                    error_message = f"Sorry, music generation failed. Status code: {response.status}"
-                    await bot.reply_to(message, error_message)
-                    user_states[message.from_user.id] = None
+            user_states[message.from_user.id] = State.AWAIT_SATISFACTION
+        else:
+            error_message = f"Sorry, music generation failed. Status code: {status}"
+            await bot.reply_to(message, error_message)
+            user_states[message.from_user.id] = State.IDLE
 
     except Exception as e:
         error_message = f"An error occurred: {str(e)}"
         await bot.reply_to(message, error_message)
-        user_states[message.from_user.id] = None
+        user_states[message.from_user.id] = State.IDLE
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id) == 'awaiting_satisfaction')
 async def handle_satisfaction(message):
     if message.text.lower() == 'submit':
         if message.from_user.id in user_last_audio:
             try:
-                # Store the audio file in the database
-                success, msg = db_manager.update_participant_audio(
+                # Record the sent track's file_id; the submission handler resolves it when the battle is judged
+                audio_filename, file_id, file_unique_id = user_last_audio[message.from_user.id]
+                success, msg = await asyncio.to_thread(
+                    db_manager.update_participant_audio,
                     user_id=message.from_user.id,
-                    audio_file_path=user_last_audio[message.from_user.id]
+                    audio_file_id=file_id,
+                    audio_file_unique_id=file_unique_id,
+                    audio_filename=audio_filename
                 )
 
                 if success:
-                    # Clean up the temporary file after successful upload
-                    os.remove(user_last_audio[message.from_user.id])
                     await bot.send_message(
                         message.chat.id,
                         "Audio successfully submitted and recorded! 🎵",
@@ -314,7 +467,7 @@ async def handle_satisfaction(message):
                     reply_markup=ReplyKeyboardRemove()
                 )
 
-            user_states[message.from_user.id] = None
+            user_states[message.from_user.id] = State.IDLE
         else:
             await bot.send_message(
                 message.chat.id,
@@ -322,17 +475,15 @@ async def handle_satisfaction(message):
                 reply_markup=ReplyKeyboardRemove()
             )
     elif message.text.lower() == 'no':
-        if message.from_user.id in user_last_audio:
-            # Clean up the temporary file
-            os.remove(user_last_audio[message.from_user.id])
-            del user_last_audio[message.from_user.id]
+        # Discard the rejected track
+        user_last_audio.pop(message.from_user.id, None)
 
         await bot.send_message(
             message.chat.id,
             "No problem! Use /generate command again to create another music file.",
             reply_markup=ReplyKeyboardRemove()
         )
-        user_states[message.from_user.id] = None
+        user_states[message.from_user.id] = State.IDLE
     else:
         await bot.send_message(
             message.chat.id,
@@ -353,18 +504,82 @@ async def about_bot(message):
     )
     await bot.send_message(message.chat.id, about_text, parse_mode="Markdown")
 
-@bot.message_handler(func=lambda message: True)
 async def handle_other_messages(message):
     await bot.reply_to(message, "Please use /generate to create music or /about to learn more about the bot.")
 
+STATE_HANDLERS = {
+    State.AWAIT_WALLET: verify_wallet,
+    State.AWAIT_PROMPT: generate_music,
+    State.AWAIT_SATISFACTION: handle_satisfaction,
+}
+
+@bot.message_handler(func=lambda message: True)
+async def dispatch_message(message):
+    """Route non-command messages to the handler for the user's conversation state"""
+    handler = STATE_HANDLERS.get(user_states.get(message.from_user.id, State.IDLE), handle_other_messages)
+    await handler(message)
+
+async def run_polling():
+    while True:
+        try:
+            await bot.polling(non_stop=True, timeout=60)
+            break
+        except ApiTelegramException as e:
+            logger.error(f"Bot polling error: {e}")
+            await asyncio.sleep(get_retry_after(e) or 5)
+        except Exception as e:
+            logger.error(f"Bot polling error: {e}")
+            await asyncio.sleep(5)
+
+# Handler tasks spawned from webhook updates, referenced so they are not garbage collected
+WEBHOOK_TASKS = set()
+
+async def run_webhook():
+    """Receive updates pushed by Telegram instead of polling for them"""
+    secret_token = secrets.token_urlsafe(32)
+
+    async def handle_update(request):
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+            return web.Response(status=403)
+        update = types.Update.de_json(await request.text())
+        # Answer Telegram right away; generation can take far longer than its webhook timeout
+        task = asyncio.create_task(bot.process_new_updates([update]))
+        WEBHOOK_TASKS.add(task)
+        task.add_done_callback(WEBHOOK_TASKS.discard)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post('/webhook', handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=WEBHOOK_PORT).start()
+    await bot.set_webhook(url=f"{WEBHOOK_URL}/webhook", secret_token=secret_token)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await bot.remove_webhook()
+        await runner.cleanup()
+
 async def main():
+    global SESSION
     print("Bot is running...")
+    # Let short handlers run to completion without an extra event loop round trip (Python 3.12+)
+    if hasattr(asyncio, 'eager_task_factory'):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=300, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=180),
+        json_serialize=(lambda obj: orjson.dumps(obj).decode()) if orjson is not None else json.dumps
+    )
     try:
-        await bot.polling(non_stop=True, timeout=60)
-    except Exception as e:
-        logger.error(f"Bot polling error: {e}")
-        await asyncio.sleep(5)
-        await main()
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        await SESSION.close()
 
 if __name__ == '__main__':
+    if uvloop is not None and sys.platform != 'win32':
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
@@ -1,214 +1,306 @@
-import telebot
-from web3 import Web3
-import time
-import mysql.connector
-import threading
-from datetime import datetime
-
-class Config:
-    BOT_TOKEN = "************************"
-    WEB3_PROVIDER = "https://data-seed-prebsc-1-s1.binance.org:8545"
-    CONTRACT_ADDRESS = "0xA546819d48330FB2E02D3424676d13D7B8af3bB2"
-    CONTRACT_ABI = [{"inputs":[],"stateMutability":"nonpayable","type":"constructor"},{"anonymous":"false","inputs":[{"indexed":"true","internalType":"address","name":"recipient","type":"address"},{"indexed":"false","internalType":"uint256","name":"amount","type":"uint256"}],"name":"FundsSent","type":"event"},{"anonymous":"false","inputs":[{"indexed":"true","internalType":"address","name":"user","type":"address"},{"indexed":"false","internalType":"uint256","name":"amount","type":"uint256"}],"name":"Staked","type":"event"},{"inputs":[],"name":"STAKE_AMOUNT","outputs":[{"internalType":"uint256","name":"","type":"uint256"}],"stateMutability":"view","type":"function"},{"inputs":[{"internalType":"address","name":"","type":"address"}],"name":"hasStaked","outputs":[{"internalType":"bool","name":"","type":"bool"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"owner","outputs":[{"internalType":"address","name":"","type":"address"}],"stateMutability":"view","type":"function"},{"inputs":[{"internalType":"address payable","name":"recipient","type":"address"}],"name":"sendFundsTo","outputs":[],"stateMutability":"nonpayable","type":"function"},{"inputs":[],"name":"stake","outputs":[],"stateMutability":"payable","type":"function"},{"inputs":[{"internalType":"address","name":"user","type":"address"}],"name":"verifyStake","outputs":[{"internalType":"bool","name":"","type":"bool"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"withdraw","outputs":[],"stateMutability":"nonpayable","type":"function"}]
-    STAKE_PAGE_URL = "***********************"
-    STAKE_AMOUNT = "0.0002"
-    BASE_GROUP_INVITE_LINK = "https://t.me/+NxOSoOVa-BUwYWVl"
-    FIXED_CHAT_ID = -4701503942
-    
-    # MySQL Configuration
-    DB_HOST = "****************"
-    DB_NAME = "****************"
-    DB_USER = "****************"
-    DB_PASSWORD = "************"
-
-class DatabaseManager:
-    def __init__(self):
-        self._lock = threading.Lock()
-        self._init_database()
-
-    def _get_connection(self):
-        """Create and return a new database connection"""
-        return mysql.connector.connect(
-            host=Config.DB_HOST,
-            database=Config.DB_NAME,
-            user=Config.DB_USER,
-            password=Config.DB_PASSWORD
-        )
-
-    def _init_database(self):
-        """Initialize database with participants table"""
-        with self._lock:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            
-            try:
-                # Create participants table if it doesn't exist
-                cursor.execute('''
-                CREATE TABLE IF NOT EXISTS participants (
-                    user_id BIGINT,
-                    username VARCHAR(255),
-                    wallet_address VARCHAR(255),
-                    audio_data LONGBLOB,
-                    audio_filename VARCHAR(255),
-                    chat_id BIGINT,
-                    verified BOOLEAN DEFAULT 1,
-                    battle_start_timestamp DATETIME,
-                    battle_active BOOLEAN DEFAULT 0,
-                    PRIMARY KEY (user_id, chat_id)
-                )
-                ''')
-
-                
-                conn.commit()
-            except mysql.connector.Error as e:
-                print(f"Error initializing database: {e}")
-                raise
-            finally:
-                cursor.close()
-                conn.close()
-
-    def update_participant_info(self, user_id, username, wallet_address, chat_id=None):
-        """Update or insert participant information"""
-        chat_id = Config.FIXED_CHAT_ID
-        with self._lock:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            try:
-                current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Using MySQL's INSERT ... ON DUPLICATE KEY UPDATE
-                cursor.execute('''
-                INSERT INTO participants
-                (user_id, username, wallet_address, chat_id, verified,
-                 battle_start_timestamp, battle_active, audio_data, audio_filename)
-                VALUES (%s, %s, %s, %s, 1, %s, 0, NULL, NULL)
-                ON DUPLICATE KEY UPDATE
-                username = COALESCE(VALUES(username), username),
-                wallet_address = COALESCE(VALUES(wallet_address), wallet_address),
-                verified = 1,
-                battle_start_timestamp = COALESCE(battle_start_timestamp, VALUES(battle_start_timestamp)),
-                battle_active = COALESCE(battle_active, 0)
-                ''', (user_id, username, wallet_address, chat_id, current_time))
-                
-                conn.commit()
-                return True
-            except mysql.connector.Error as e:
-                print(f"Database error in update_participant_info: {e}")
-                return False
-            finally:
-                cursor.close()
-                conn.close()
-
-
-class BattleOfTunesBot:
-    def __init__(self):
-        self.bot = telebot.TeleBot(Config.BOT_TOKEN)
-        self.web3 = Web3(Web3.HTTPProvider(Config.WEB3_PROVIDER))
-        self.contract = self.web3.eth.contract(
-            address=Web3.to_checksum_address(Config.CONTRACT_ADDRESS),
-            abi=Config.CONTRACT_ABI
-        )
-        self.db = DatabaseManager()
-        self._setup_handlers()
-
-    def _setup_handlers(self):
-        @self.bot.message_handler(commands=['start'])
-        def start_handler(message):
-            welcome_message = (
-                "Welcome to Battle of Tunes! 🎵\n\n"
-                "Available commands:\n"
-                "/stake <wallet_address> - Start the staking process to participate\n"
-                "/verify <wallet_address> - Verify your existing stake\n\n"
-                "To participate in Battle of Tunes, you'll need to stake first. "
-                "Use the /stake command followed by your wallet address to begin!"
-            )
-            self.bot.reply_to(message, welcome_message)
-
-        @self.bot.message_handler(commands=['stake'])
-        def stake_handler(message):
-            try:
-                command_parts = message.text.split()
-                if len(command_parts) != 2:
-                    self.bot.reply_to(message, "Usage: /stake <wallet_address>")
-                    return
-
-                user_wallet = command_parts[1]
-                if not self.web3.is_address(user_wallet):
-                    self.bot.reply_to(message, "Invalid wallet address. Please provide a valid address.")
-                    return
-
-                stake_link = f"{Config.STAKE_PAGE_URL}?wallet={user_wallet}&amount={Config.STAKE_AMOUNT}"
-                self.bot.reply_to(message,
-                    f"Please complete your staking by visiting the link below:\n\n{stake_link}")
-                self.bot.reply_to(message, "Waiting for transaction confirmation...")
-
-                for _ in range(18):  # 3 minute timeout
-                    if self._verify_stake(user_wallet):
-                        if self._handle_successful_stake(message, user_wallet):
-                            success_message = (
-                                "🎉 Staking verified! You are now registered for Battle of Tunes.\n\n"
-                                "👥 Join the lobby by clicking here:\n"
-                                f"{Config.BASE_GROUP_INVITE_LINK}"
-                            )
-                            self.bot.reply_to(message, success_message)
-                            return
-                        break
-                    time.sleep(10)
-
-                self.bot.reply_to(message,
-                    "Staking not detected. Please ensure the transaction was completed successfully.")
-
-            except Exception as e:
-                self.bot.reply_to(message, f"An error occurred: {str(e)}")
-
-        @self.bot.message_handler(commands=['verify'])
-        def verify_stake_handler(message):
-            try:
-                command_parts = message.text.split()
-                if len(command_parts) != 2:
-                    self.bot.reply_to(message, "Usage: /verify <wallet_address>")
-                    return
-
-                user_wallet = command_parts[1]
-                if not self.web3.is_address(user_wallet):
-                    self.bot.reply_to(message, "Invalid wallet address. Please provide a valid address.")
-                    return
-
-                if self._verify_stake(user_wallet):
-                    if self._handle_successful_stake(message, user_wallet):
-                        success_message = (
-                            "✅ Stake verified! Your registration is confirmed.\n\n"
-                            "👥 Join the lobby by clicking here:\n"
-                            f"{Config.BASE_GROUP_INVITE_LINK}"
-                        )
-                        self.bot.reply_to(message, success_message)
-                        return
-                else:
-                    self.bot.reply_to(message, "You have not staked the required amount.")
-
-            except Exception as e:
-                self.bot.reply_to(message, f"An error occurred: {str(e)}")
-
-    def _verify_stake(self, user_wallet):
-        try:
-            return self.contract.functions.verifyStake(user_wallet).call()
-        except Exception as e:
-            print(f"Error verifying stake: {e}")
-            return False
-
-    def _handle_successful_stake(self, message, wallet_address):
-        success = self.db.update_participant_info(
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            wallet_address=wallet_address,
-            chat_id=Config.FIXED_CHAT_ID
-        )
-        return success
-
-    def run(self):
-        print("Bot is running...")
-        self.bot.polling()
-
-if __name__ == "__main__":
-    bot = BattleOfTunesBot()
-    bot.run()
+import telebot
+from web3 import Web3
+from hexbytes import HexBytes
+import time
+import re
+import mysql.connector
+import threading
+import functools
+from datetime import datetime
+from cachetools import TTLCache
+from dbpool import ConnectionPool, init_participants_table
+
+# 0x-prefixed 20-byte hex address; checked before web3's checksum validation
+WALLET_ADDRESS_PATTERN = re.compile(r'0x[0-9a-fA-F]{40}')
+
+# Contract calls need EIP-55 addresses; the same wallets are checked repeatedly, so memoize the keccak
+checksum_address = functools.lru_cache(maxsize=4096)(Web3.to_checksum_address)
+
+class Config:
+    BOT_TOKEN = "************************"
+    WEB3_PROVIDER = "https://data-seed-prebsc-1-s1.binance.org:8545"
+    CONTRACT_ADDRESS = "0xA546819d48330FB2E02D3424676d13D7B8af3bB2"
+    CONTRACT_ABI = [{"inputs":[],"stateMutability":"nonpayable","type":"constructor"},{"anonymous":"false","inputs":[{"indexed":"true","internalType":"address","name":"recipient","type":"address"},{"indexed":"false","internalType":"uint256","name":"amount","type":"uint256"}],"name":"FundsSent","type":"event"},{"anonymous":"false","inputs":[{"indexed":"true","internalType":"address","name":"user","type":"address"},{"indexed":"false","internalType":"uint256","name":"amount","type":"uint256"}],"name":"Staked","type":"event"},{"inputs":[],"name":"STAKE_AMOUNT","outputs":[{"internalType":"uint256","name":"","type":"uint256"}],"stateMutability":"view","type":"function"},{"inputs":[{"internalType":"address","name":"","type":"address"}],"name":"hasStaked","outputs":[{"internalType":"bool","name":"","type":"bool"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"owner","outputs":[{"internalType":"address","name":"","type":"address"}],"stateMutability":"view","type":"function"},{"inputs":[{"internalType":"address payable","name":"recipient","type":"address"}],"name":"sendFundsTo","outputs":[],"stateMutability":"nonpayable","type":"function"},{"inputs":[],"name":"stake","outputs":[],"stateMutability":"payable","type":"function"},{"inputs":[{"internalType":"address","name":"user","type":"address"}],"name":"verifyStake","outputs":[{"internalType":"bool","name":"","type":"bool"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"withdraw","outputs":[],"stateMutability":"nonpayable","type":"function"}]
+    STAKE_PAGE_URL = "***********************"
+    STAKE_AMOUNT = "0.0002"
+    BASE_GROUP_INVITE_LINK = "https://t.me/+NxOSoOVa-BUwYWVl"
+    FIXED_CHAT_ID = -4701503942
+    STAKE_TIMEOUT = 180  # Seconds to wait for a stake after /stake
+    STAKE_POLL_INTERVAL = 5  # Seconds between Staked event log checks
+    STAKE_LOG_MAX_BLOCKS = 1000  # Most blocks requested in one eth_getLogs call
+    SEND_RATE = 28  # Messages per second, just under Telegram's ~30/s bot limit
+    
+    # MySQL Configuration
+    DB_HOST = "****************"
+    DB_NAME = "****************"
+    DB_USER = "****************"
+    DB_PASSWORD = "************"
+
+class DatabaseManager:
+    def __init__(self):
+        # One pooled connection per bot worker thread plus the stake watcher
+        self.pool = ConnectionPool(
+            pool_name='staking_pool',
+            pool_size=9,
+            host=Config.DB_HOST,
+            database=Config.DB_NAME,
+            user=Config.DB_USER,
+            password=Config.DB_PASSWORD
+        )
+        self._init_database()
+
+    def _init_database(self):
+        """Initialize database with participants table"""
+        try:
+            with self.pool.cursor() as (conn, cursor):
+                init_participants_table(cursor)
+                conn.commit()
+        except mysql.connector.Error as e:
+            print(f"Error initializing database: {e}")
+            raise
+
+    def update_participant_info(self, user_id, username, wallet_address, chat_id=None):
+        """Update or insert participant information"""
+        chat_id = Config.FIXED_CHAT_ID
+        try:
+            with self.pool.cursor() as (conn, cursor):
+                current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+                # Using MySQL's INSERT ... ON DUPLICATE KEY UPDATE
+                cursor.execute('''
+                INSERT INTO participants
+                (user_id, username, wallet_address, chat_id, verified,
+                 battle_start_timestamp, battle_active, audio_file_id, audio_filename)
+                VALUES (%s, %s, %s, %s, 1, %s, 0, NULL, NULL)
+                ON DUPLICATE KEY UPDATE
+                username = COALESCE(VALUES(username), username),
+                wallet_address = COALESCE(VALUES(wallet_address), wallet_address),
+                verified = 1,
+                battle_start_timestamp = COALESCE(battle_start_timestamp, VALUES(battle_start_timestamp)),
+                battle_active = COALESCE(battle_active, 0)
+                ''', (user_id, username, wallet_address, chat_id, current_time))
+
+                conn.commit()
+                return True
+        except mysql.connector.Error as e:
+            print(f"Database error in update_participant_info: {e}")
+            return False
+
+
+class RateLimitedTeleBot(telebot.TeleBot):
+    """TeleBot whose outbound messages are spaced to stay under Telegram's send limit"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._send_lock = threading.Lock()
+        self._next_send_time = 0.0
+
+    def send_message(self, *args, **kwargs):
+        # reply_to() goes through send_message(), so replies are limited too
+        with self._send_lock:
+            now = time.monotonic()
+            send_time = max(now, self._next_send_time)
+            self._next_send_time = send_time + 1 / Config.SEND_RATE
+        if send_time > now:
+            time.sleep(send_time - now)
+        return super().send_message(*args, **kwargs)
+
+
+class BattleOfTunesBot:
+    def __init__(self):
+        # Handlers make blocking RPC and DB calls; let several users' updates run at once
+        self.bot = RateLimitedTeleBot(Config.BOT_TOKEN, num_threads=8)
+        # HTTPProvider keeps one keep-alive requests.Session per calling thread, so each worker reuses its connection
+        self.web3 = Web3(Web3.HTTPProvider(Config.WEB3_PROVIDER))
+        self.contract = self.web3.eth.contract(
+            address=Web3.to_checksum_address(Config.CONTRACT_ADDRESS),
+            abi=Config.CONTRACT_ABI
+        )
+        self._verify_stake_fn = self.contract.functions.verifyStake
+        self.db = DatabaseManager()
+        self._staked_topic = Web3.to_hex(Web3.keccak(text="Staked(address,uint256)"))
+        # Wallets waiting for a Staked event: lowercase address -> (message, wallet, deadline)
+        self._pending_stakes = {}
+        self._pending_lock = threading.Lock()
+        # Recent verifyStake answers; a stake rarely disappears, while a missing one may land any block
+        self._staked_wallets = TTLCache(maxsize=10_000, ttl=60)
+        self._unstaked_wallets = TTLCache(maxsize=10_000, ttl=5)
+        self._stake_cache_lock = threading.Lock()
+        self._setup_handlers()
+
+    def _setup_handlers(self):
+        @self.bot.message_handler(commands=['start'])
+        def start_handler(message):
+            welcome_message = (
+                "Welcome to Battle of Tunes! 🎵\n\n"
+                "Available commands:\n"
+                "/stake <wallet_address> - Start the staking process to participate\n"
+                "/verify <wallet_address> - Verify your existing stake\n\n"
+                "To participate in Battle of Tunes, you'll need to stake first. "
+                "Use the /stake command followed by your wallet address to begin!"
+            )
+            self.bot.reply_to(message, welcome_message)
+
+        @self.bot.message_handler(commands=['stake'])
+        def stake_handler(message):
+            try:
+                command_parts = message.text.split()
+                if len(command_parts) != 2:
+                    self.bot.reply_to(message, "Usage: /stake <wallet_address>")
+                    return
+
+                user_wallet = command_parts[1]
+                if not self._is_valid_wallet(user_wallet):
+                    self.bot.reply_to(message, "Invalid wallet address. Please provide a valid address.")
+                    return
+
+                stake_link = f"{Config.STAKE_PAGE_URL}?wallet={user_wallet}&amount={Config.STAKE_AMOUNT}"
+                self.bot.reply_to(message,
+                    f"Please complete your staking by visiting the link below:\n\n{stake_link}")
+                self.bot.reply_to(message, "Waiting for transaction confirmation...")
+
+                if self._verify_stake(user_wallet):
+                    self._complete_stake(message, user_wallet)
+                    return
+
+                # The stake watcher replies once the Staked event arrives or the wait times out
+                with self._pending_lock:
+                    self._pending_stakes[user_wallet.lower()] = (
+                        message, user_wallet, time.monotonic() + Config.STAKE_TIMEOUT)
+
+            except Exception as e:
+                self.bot.reply_to(message, f"An error occurred: {str(e)}")
+
+        @self.bot.message_handler(commands=['verify'])
+        def verify_stake_handler(message):
+            try:
+                command_parts = message.text.split()
+                if len(command_parts) != 2:
+                    self.bot.reply_to(message, "Usage: /verify <wallet_address>")
+                    return
+
+                user_wallet = command_parts[1]
+                if not self._is_valid_wallet(user_wallet):
+                    self.bot.reply_to(message, "Invalid wallet address. Please provide a valid address.")
+                    return
+
+                if self._verify_stake(user_wallet):
+                    if self._handle_successful_stake(message, user_wallet):
+                        success_message = (
+                            "✅ Stake verified! Your registration is confirmed.\n\n"
+                            "👥 Join the lobby by clicking here:\n"
+                            f"{Config.BASE_GROUP_INVITE_LINK}"
+                        )
+                        self.bot.reply_to(message, success_message)
+                        return
+                else:
+                    self.bot.reply_to(message, "You have not staked the required amount.")
+
+            except Exception as e:
+                self.bot.reply_to(message, f"An error occurred: {str(e)}")
+
+    def _is_valid_wallet(self, user_wallet):
+        """Reject malformed input with the regex before web3 hashes it for the checksum"""
+        return WALLET_ADDRESS_PATTERN.fullmatch(user_wallet) is not None and self.web3.is_address(user_wallet)
+
+    def _verify_stake(self, user_wallet):
+        key = user_wallet.lower()
+        with self._stake_cache_lock:
+            if key in self._staked_wallets:
+                return True
+            if key in self._unstaked_wallets:
+                return False
+        try:
+            staked = self._verify_stake_fn(checksum_address(user_wallet)).call()
+        except Exception as e:
+            print(f"Error verifying stake: {e}")
+            return False
+        with self._stake_cache_lock:
+            (self._staked_wallets if staked else self._unstaked_wallets)[key] = True
+        return staked
+
+    def _complete_stake(self, message, user_wallet):
+        """Register a confirmed stake and send the user the lobby link"""
+        if self._handle_successful_stake(message, user_wallet):
+            success_message = (
+                "🎉 Staking verified! You are now registered for Battle of Tunes.\n\n"
+                "👥 Join the lobby by clicking here:\n"
+                f"{Config.BASE_GROUP_INVITE_LINK}"
+            )
+            self.bot.reply_to(message, success_message)
+        else:
+            self.bot.reply_to(message,
+                "Staking not detected. Please ensure the transaction was completed successfully.")
+
+    def _fetch_staked_wallets(self, from_block, to_block):
+        """Return the lowercase wallets that emitted Staked events in the given block range"""
+        logs = self.web3.eth.get_logs({
+            'address': self.contract.address,
+            'topics': [self._staked_topic],
+            'fromBlock': from_block,
+            'toBlock': to_block
+        })
+        # The indexed user is the second topic; read it directly rather than ABI-decoding the log
+        return {'0x' + bytes(HexBytes(log['topics'][1])[-20:]).hex() for log in logs}
+
+    def _watch_stakes(self):
+        """Resolve pending /stake requests from the contract's Staked event logs"""
+        last_block = None
+        while True:
+            time.sleep(Config.STAKE_POLL_INTERVAL)
+            staked_wallets = set()
+            try:
+                latest_block = self.web3.eth.block_number
+                if last_block is None:
+                    last_block = latest_block
+                if latest_block > last_block:
+                    # Stay within the RPC's getLogs range limit after an outage; stakes in skipped
+                    # blocks are still caught by the final verifyStake check when they expire
+                    from_block = max(last_block + 1, latest_block - Config.STAKE_LOG_MAX_BLOCKS + 1)
+                    staked_wallets = self._fetch_staked_wallets(from_block, latest_block)
+                    last_block = latest_block
+            except Exception as e:
+                print(f"Error fetching Staked events: {e}")
+
+            now = time.monotonic()
+            with self._pending_lock:
+                confirmed = [self._pending_stakes.pop(wallet)
+                             for wallet in staked_wallets & self._pending_stakes.keys()]
+                expired = [self._pending_stakes.pop(wallet)
+                           for wallet, (_, _, deadline) in list(self._pending_stakes.items())
+                           if deadline <= now]
+
+            for message, user_wallet, _ in confirmed:
+                try:
+                    self._complete_stake(message, user_wallet)
+                except Exception as e:
+                    print(f"Error completing stake for {user_wallet}: {e}")
+            for message, user_wallet, _ in expired:
+                try:
+                    # Last direct check in case the event was missed or fell outside the watched range
+                    if self._verify_stake(user_wallet):
+                        self._complete_stake(message, user_wallet)
+                    else:
+                        self.bot.reply_to(message,
+                            "Staking not detected. Please ensure the transaction was completed successfully.")
+                except Exception as e:
+                    print(f"Error completing stake for {user_wallet}: {e}")
+
+    def _handle_successful_stake(self, message, wallet_address):
+        success = self.db.update_participant_info(
+            user_id=message.from_user.id,
+            username=message.from_user.username,
+            wallet_address=wallet_address,
+            chat_id=Config.FIXED_CHAT_ID
+        )
+        return success
+
+    def run(self):
+        print("Bot is running...")
+        threading.Thread(target=self._watch_stakes, daemon=True).start()
+        # Telegram holds each getUpdates for up to 30s, and restarts polling after network errors
+        self.bot.infinity_polling(timeout=30, long_polling_timeout=30, allowed_updates=['message'])
+
+if __name__ == "__main__":
+    bot = BattleOfTunesBot()
+    bot.run()
@@ -8,6 +8,7 @@ from telebot.async_telebot import AsyncTeleBot
 from telebot.handler_backends import State, StatesGroup
 from telebot.storage import StateMemoryStorage
 import aiohttp
+from dbpool import ConnectionPool, init_participants_table
 
 # Logging setup
 logging.basicConfig(
@@ -17,6 +18,11 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 AUDIO_GEN_BOT_USERNAME = "@musicgen_051203_bot"
+# file_ids are only valid for the bot that sent the file, so tracks are fetched with the generation bot's token
+AUDIO_GEN_BOT_TOKEN = '****************************'
+
+# Most get_chat_member calls the battle checker has in flight at once
+MEMBERSHIP_CHECK_CONCURRENCY = 5
 
 # MySQL Configuration
 MYSQL_CONFIG = {
@@ -29,6 +35,12 @@ MYSQL_CONFIG = {
 class ParticipantsDatabase:
     def __init__(self):
         self._init_database()
+        # Reuse connections across queries instead of reconnecting for every call
+        self.pool = ConnectionPool(
+            pool_name='submission_pool',
+            pool_size=4,
+            **MYSQL_CONFIG
+        )
 
     def _init_database(self):
         """Create the database tables if they don't exist."""
@@ -45,22 +57,7 @@ class ParticipantsDatabase:
             cursor.execute(f"CREATE DATABASE IF NOT EXISTS {MYSQL_CONFIG['database']}")
             cursor.execute(f"USE {MYSQL_CONFIG['database']}")
 
-            # Create participants table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS participants (
-                    user_id BIGINT,
-                    username VARCHAR(255),
-                    wallet_address VARCHAR(255),
-                    audio_filename VARCHAR(255),
-                    audio_data LONGBLOB,
-                    chat_id BIGINT,
-                    verified BOOLEAN DEFAULT 1,
-                    battle_start_timestamp TIMESTAMP,
-                    battle_active BOOLEAN DEFAULT 0,
-                    PRIMARY KEY (user_id, chat_id)
-                )
-            ''')
-
+            init_participants_table(cursor)
             conn.commit()
 
         except mysql.connector.Error as e:
@@ -70,201 +67,147 @@ class ParticipantsDatabase:
             cursor.close()
             conn.close()
 
-    def _get_connection(self):
-        """Create a new MySQL connection."""
-        return mysql.connector.connect(**MYSQL_CONFIG)
-
     def get_all_inactive_participants(self):
         """Get all participants who aren't in an active battle"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                SELECT user_id, username, wallet_address, chat_id
-                FROM participants
-                WHERE battle_active = 0
-                ORDER BY COALESCE(battle_start_timestamp, NOW()) DESC
-            ''')
-            return cursor.fetchall()
+            with self.pool.cursor() as (conn, cursor):
+                cursor.execute('''
+                    SELECT user_id, username, wallet_address, chat_id
+                    FROM participants
+                    WHERE battle_active = 0
+                    ORDER BY COALESCE(battle_start_timestamp, NOW()) DESC
+                ''')
+                return cursor.fetchall()
 
         except mysql.connector.Error as e:
             logger.error(f"Database error: {e}")
             return []
-        finally:
-            cursor.close()
-            conn.close()
-
-    def get_participants(self, chat_id):
-        """Get active participants for a specific group"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                SELECT user_id, username, wallet_address, audio_filename, audio_data
-                FROM participants
-                WHERE chat_id = %s AND battle_active = 1
-            ''', (chat_id,))
-            results = cursor.fetchall()
-
-            participants = {}
-            for result in results:
-                participants[result[0]] = {
-                    'username': result[1],
-                    'wallet_address': result[2],
-                    'audio_filename': result[3],
-                    'audio_data': result[4]
-                }
-
-            return participants
-
-        except mysql.connector.Error as e:
-            logger.error(f"Database error: {e}")
-            return {}
-        finally:
-            cursor.close()
-            conn.close()
 
     def get_all_participants_for_chat(self, chat_id):
         """Get all participants for a specific group"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                SELECT username, wallet_address, battle_active
-                FROM participants
-                WHERE chat_id = %s
-                ORDER BY battle_active DESC, username
-            ''', (chat_id,))
-            return cursor.fetchall()
+            with self.pool.cursor() as (conn, cursor):
+                cursor.execute('''
+                    SELECT username, wallet_address, battle_active
+                    FROM participants
+                    WHERE chat_id = %s
+                    ORDER BY battle_active DESC, username
+                ''', (chat_id,))
+                return cursor.fetchall()
 
         except mysql.connector.Error as e:
             logger.error(f"Database error: {e}")
             return []
-        finally:
-            cursor.close()
-            conn.close()
 
     def activate_battle_for_users(self, user_ids, chat_id):
         """Activate battle for specified users in a chat"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         try:
-            placeholders = ', '.join(['%s'] * len(user_ids))
-            cursor.execute(f'''
-                UPDATE participants
-                SET battle_active = 1,
-                    battle_start_timestamp = NOW()
-                WHERE user_id IN ({placeholders}) AND chat_id = %s
-            ''', (*user_ids, chat_id))
-
-            conn.commit()
-            return True
+            with self.pool.cursor() as (conn, cursor):
+                placeholders = ', '.join(['%s'] * len(user_ids))
+                cursor.execute(f'''
+                    UPDATE participants
+                    SET battle_active = 1,
+                        battle_start_timestamp = NOW()
+                    WHERE user_id IN ({placeholders}) AND chat_id = %s
+                ''', (*user_ids, chat_id))
+
+                conn.commit()
+                return True
 
         except mysql.connector.Error as e:
             logger.error(f"Database error: {e}")
             return False
-        finally:
-            cursor.close()
-            conn.close()
 
     def check_user_in_battle(self, user_id, chat_id):
         """Check if user is in active battle"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                SELECT COUNT(*)
-                FROM participants
-                WHERE user_id = %s AND chat_id = %s AND battle_active = 1
-            ''', (user_id, chat_id))
-            result = cursor.fetchone()
-            return result[0] > 0
+            with self.pool.cursor() as (conn, cursor):
+                cursor.execute('''
+                    SELECT 1
+                    FROM participants
+                    WHERE user_id = %s AND chat_id = %s AND battle_active = 1
+                    LIMIT 1
+                ''', (user_id, chat_id))
+                return cursor.fetchone() is not None
 
         except mysql.connector.Error as e:
             logger.error(f"Database error: {e}")
             return False
-        finally:
-            cursor.close()
-            conn.close()
 
     def check_all_participants_submitted(self, chat_id):
         """Check if all participants have submitted audio"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                SELECT COUNT(*)
-                FROM participants
-                WHERE chat_id = %s AND battle_active = 1 AND audio_data IS NULL
-            ''', (chat_id,))
-            result = cursor.fetchone()
-            return result[0] == 0
+            with self.pool.cursor() as (conn, cursor):
+                cursor.execute('''
+                    SELECT EXISTS(
+                        SELECT 1
+                        FROM participants
+                        WHERE chat_id = %s AND battle_active = 1 AND audio_file_id IS NULL
+                    )
+                ''', (chat_id,))
+                result = cursor.fetchone()
+                return result[0] == 0
 
         except mysql.connector.Error as e:
             logger.error(f"Database error: {e}")
             return False
-        finally:
-            cursor.close()
-            conn.close()
 
     def get_participants_for_submission(self, chat_id):
-        """Get participants with their audio files"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
+        """Get participants with their usernames and the Telegram file_ids of their audio"""
         try:
-            cursor.execute('''
-                SELECT wallet_address, audio_data
-                FROM participants
-                WHERE chat_id = %s AND battle_active = 1 AND audio_data IS NOT NULL
-            ''', (chat_id,))
-            return [
-                {
-                    'wallet_address': result[0],
-                    'audio_file': result[1]
-                }
-                for result in cursor.fetchall()
-            ]
+            with self.pool.cursor(dictionary=True) as (conn, cursor):
+                cursor.execute('''
+                    SELECT username, wallet_address, audio_file_id, audio_file_unique_id
+                    FROM participants
+                    WHERE chat_id = %s AND battle_active = 1 AND audio_file_id IS NOT NULL
+                ''', (chat_id,))
+                return cursor.fetchall()
 
         except mysql.connector.Error as e:
             logger.error(f"Database error: {e}")
             return []
-        finally:
-            cursor.close()
-            conn.close()
+
+    def clear_submissions(self, chat_id):
+        """Forget the submitted tracks of a group's active battle so they can be submitted again"""
+        try:
+            with self.pool.cursor() as (conn, cursor):
+                cursor.execute('''
+                    UPDATE participants
+                    SET audio_file_id = NULL, audio_file_unique_id = NULL, audio_filename = NULL
+                    WHERE chat_id = %s AND battle_active = 1
+                ''', (chat_id,))
+                conn.commit()
+
+        except mysql.connector.Error as e:
+            logger.error(f"Database error: {e}")
 
     def reset_battle(self, chat_id):
         """Delete participants who were in the battle for a specific group"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                DELETE FROM participants
-                WHERE chat_id = %s AND battle_active = 1
-            ''', (chat_id,))
-            conn.commit()
+            with self.pool.cursor() as (conn, cursor):
+                cursor.execute('''
+                    DELETE FROM participants
+                    WHERE chat_id = %s AND battle_active = 1
+                ''', (chat_id,))
+                conn.commit()
 
         except mysql.connector.Error as e:
             logger.error(f"Database error: {e}")
-        finally:
-            cursor.close()
-            conn.close()
 
 
 class SongBattleBot:
     def __init__(self, token):
         self.token = token
         self.bot = AsyncTeleBot(token, state_storage=StateMemoryStorage())
+        # Only used to resolve submitted tracks' file_ids; it never polls
+        self.audio_bot = AsyncTeleBot(AUDIO_GEN_BOT_TOKEN)
         self.participants_db = ParticipantsDatabase()
         self.evaluation_tasks = {}
         self.active_battles = set()
+        # Bounds the membership lookups check_for_battles makes every 10s, to stay clear of flood control
+        self.membership_checks = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+        # Shared HTTP session for audio downloads and the evaluation API, created in run()
+        self.session = None
         self.setup_handlers()
 
     def setup_handlers(self):
@@ -283,7 +226,9 @@ class SongBattleBot:
             )
 
             # Get current participants
-            participants = self.participants_db.get_all_participants_for_chat(message.chat.id)
+            participants = await asyncio.to_thread(
+                self.participants_db.get_all_participants_for_chat, message.chat.id
+            )
 
             if participants:
                 participant_text = "👥 Current Participants:\n\n"
@@ -313,7 +258,7 @@ class SongBattleBot:
             user_id = message.from_user.id
             chat_id = message.chat.id
 
-            if not self.participants_db.check_user_in_battle(user_id, chat_id):
+            if not await asyncio.to_thread(self.participants_db.check_user_in_battle, user_id, chat_id):
                 await self.bot.reply_to(
                     message,
                     "You are not currently participating in any active battles."
@@ -327,11 +272,16 @@ class SongBattleBot:
                 "No need to submit it here - I'll check periodically for your generated track."
             )
 
+    async def get_chat_member_limited(self, chat_id, user_id):
+        """get_chat_member, with at most MEMBERSHIP_CHECK_CONCURRENCY lookups in flight"""
+        async with self.membership_checks:
+            return await self.bot.get_chat_member(chat_id, user_id)
+
     async def check_for_battles(self):
         """Continuously check for potential battles"""
         while True:
             try:
-                all_participants = self.participants_db.get_all_inactive_participants()
+                all_participants = await asyncio.to_thread(self.participants_db.get_all_inactive_participants)
 
                 chat_participants = {}
                 for user_id, username, wallet, chat_id in all_participants:
@@ -344,18 +294,24 @@ class SongBattleBot:
                         continue
 
                     if len(participants) >= 3:
+                        # Look up candidates' membership concurrently, a few at a time
+                        members = await asyncio.gather(*(
+                            self.get_chat_member_limited(chat_id, user_id)
+                            for user_id, _, _ in participants
+                        ), return_exceptions=True)
+
                         valid_participants = []
-                        for user_id, username, wallet in participants:
-                            try:
-                                member = await self.bot.get_chat_member(chat_id, user_id)
-                                if member.status in ['member', 'administrator', 'creator']:
-                                    valid_participants.append((user_id, username, wallet))
-                            except telebot.apihelper.ApiTelegramException:
+                        for participant, member in zip(participants, members):
+                            if isinstance(member, telebot.apihelper.ApiTelegramException):
                                 continue
+                            if isinstance(member, Exception):
+                                raise member
+                            if member.status in ['member', 'administrator', 'creator']:
+                                valid_participants.append(participant)
 
                         if len(valid_participants) == 3:
                             user_ids = [p[0] for p in valid_participants]
-                            if self.participants_db.activate_battle_for_users(user_ids, chat_id):
+                            if await asyncio.to_thread(self.participants_db.activate_battle_for_users, user_ids, chat_id):
                                 self.active_battles.add(chat_id)
                                 await self.start_battle(chat_id, valid_participants)
 
@@ -391,7 +347,7 @@ class SongBattleBot:
         """Monitor battle submissions by checking database"""
         try:
             while True:
-                if self.participants_db.check_all_participants_submitted(chat_id):
+                if await asyncio.to_thread(self.participants_db.check_all_participants_submitted, chat_id):
                     # Send announcement that submissions are received
                     await self.bot.send_message(
                         chat_id,
@@ -405,8 +361,17 @@ class SongBattleBot:
                     )
 
                     # Proceed with evaluation
-                    await self.submit_to_evaluation(chat_id)
-                    return
+                    if await self.submit_to_evaluation(chat_id):
+                        return
+
+                    # The tracks could not be fetched or judged; keep the battle and collect them again
+                    await asyncio.to_thread(self.participants_db.clear_submissions, chat_id)
+                    await self.bot.send_message(
+                        chat_id,
+                        "⚠️ An error occurred during battle evaluation.\n\n"
+                        f"Please generate and submit your tracks again with {AUDIO_GEN_BOT_USERNAME}. "
+                        "The battle will be evaluated once all tracks are received."
+                    )
                 await asyncio.sleep(10)
         except Exception as e:
             logger.error(f"Monitoring error for group {chat_id}: {e}")
@@ -415,9 +380,19 @@ class SongBattleBot:
                 self.active_battles.remove(chat_id)
 
 
+    async def download_audio(self, session, file_id):
+        """Fetch a submitted track from Telegram by its file_id"""
+        # Download links expire after about an hour and embed the bot token, so resolve them only here
+        audio_url = await self.audio_bot.get_file_url(file_id)
+        async with session.get(audio_url) as response:
+            if response.status != 200:
+                # raise_for_status() would put the token-bearing URL in the logs
+                raise Exception(f"Telegram file download returned status code {response.status}")
+            return await response.read()
+
     async def submit_to_evaluation(self, chat_id):
-        """Submit to evaluation API using form-data format with MP3 files."""
-        submissions = self.participants_db.get_participants_for_submission(chat_id)
+        """Submit to evaluation API using form-data format with MP3 files; return whether it succeeded."""
+        submissions = await asyncio.to_thread(self.participants_db.get_participants_for_submission, chat_id)
 
         logger.info(f"Starting evaluation submission for chat {chat_id}")
         logger.info(f"Number of submissions received: {len(submissions)}")
@@ -430,19 +405,24 @@ class SongBattleBot:
             files = []
             wallet_addresses = []
 
-            for idx, submission in enumerate(submissions, 1):
+            # Download each distinct submitted track from Telegram once; tracks shared by
+            # identical prompts have the same file_unique_id
+            file_ids = {}
+            for submission in submissions:
+                unique_id = submission['audio_file_unique_id'] or submission['audio_file_id']
+                file_ids.setdefault(unique_id, submission['audio_file_id'])
+            downloads = dict(zip(file_ids, await asyncio.gather(*(
+                self.download_audio(self.session, file_id) for file_id in file_ids.values()
+            ))))
+            audio_files = [
+                downloads[submission['audio_file_unique_id'] or submission['audio_file_id']]
+                for submission in submissions
+            ]
+
+            for idx, (submission, audio_bytes) in enumerate(zip(submissions, audio_files), 1):
                 logger.info(f"Submission {idx}:")
                 logger.info(f"  Wallet: {submission['wallet_address']}")
-                logger.info(f"  Audio data size: {len(submission['audio_file'])} bytes")
-
-                # Convert blob to MP3
-                audio_data = submission['audio_file']
-                if isinstance(audio_data, memoryview):
-                    audio_bytes = audio_data.tobytes()
-                elif isinstance(audio_data, bytes):
-                    audio_bytes = audio_data
-                else:
-                    audio_bytes = bytes(audio_data)
+                logger.info(f"  Audio data size: {len(audio_bytes)} bytes")
 
                 # Append to files list
                 files.append((f"track{idx}.mp3", audio_bytes))
@@ -479,23 +459,22 @@ class SongBattleBot:
             logger.info("Making API call to evaluation endpoint...")
 
             # Submit to evaluation API
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=300)  # Set a longer timeout (5 minutes)
-                async with session.post(
-                    'https://music-evaluation.onrender.com/evaluate-tracks/',
-                    data=form_data,
-                    timeout=timeout
-                ) as response:
-                    logger.info(f"API Response Status: {response.status}")
-
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"API Error Response: {error_text}")
-                        raise Exception(f"API returned status code {response.status}")
-
-                    logger.info("Successfully received API response")
-                    result = await response.json()
-                    logger.info("Successfully parsed JSON response")
+            timeout = aiohttp.ClientTimeout(total=300)  # Set a longer timeout (5 minutes)
+            async with self.session.post(
+                'https://music-evaluation.onrender.com/evaluate-tracks/',
+                data=form_data,
+                timeout=timeout
+            ) as response:
+                logger.info(f"API Response Status: {response.status}")
+
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"API Error Response: {error_text}")
+                    raise Exception(f"API returned status code {response.status}")
+
+                logger.info("Successfully received API response")
+                result = await response.json()
+                logger.info("Successfully parsed JSON response")
 
             # Process response and prepare rankings
             winner_wallet = result['winner_wallet']
@@ -510,17 +489,14 @@ class SongBattleBot:
             battle_time = datetime.fromisoformat(result['timestamp'])
             rankings_message += f"🕒 Battle completed at: {battle_time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
 
-            participants = self.participants_db.get_participants(chat_id)
+            submissions_by_wallet = {submission['wallet_address']: submission for submission in submissions}
             for idx, ranking in enumerate(result['all_rankings'], 1):
                 wallet = ranking['wallet_address']
                 score = ranking['quality_score']
                 track = ranking['file_name']
                 features = ranking['features']
 
-                participant = next(
-                    (p for p in participants.values() if p['wallet_address'] == wallet),
-                    None
-                )
+                participant = submissions_by_wallet.get(wallet)
                 username = participant['username'] if participant else "Unknown"
 
                 rankings_message += f"#{idx} @{username}\n"
@@ -544,25 +520,29 @@ class SongBattleBot:
             await self.bot.send_message(chat_id=chat_id, text=rankings_message, parse_mode='HTML')
             logger.info("Results message sent successfully")
 
-            self.participants_db.reset_battle(chat_id)
+            await asyncio.to_thread(self.participants_db.reset_battle, chat_id)
             del self.evaluation_tasks[chat_id]
             logger.info("Battle reset completed")
+            return True
 
         except Exception as e:
             logger.error(f"Evaluation error for group {chat_id}: {e}")
             logger.exception("Full exception details:")
-            await self.bot.send_message(
-                chat_id=chat_id,
-                text="⚠️ An error occurred during battle evaluation. Please try again later."
-            )
+            return False
 
 
 
     async def run(self):
         """Run the bot with battle checking"""
         logger.info("Starting bot...")
-        # Start both the battle checker and polling in parallel
-        await asyncio.gather(
-            self.check_for_battles(),
-            self.bot.polling()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(keepalive_timeout=300, ttl_dns_cache=300)
         )
+        try:
+            # Start both the battle checker and polling in parallel
+            await asyncio.gather(
+                self.check_for_battles(),
+                self.bot.polling()
+            )
+        finally:
+            await self.session.close()